@@ -1,21 +1,30 @@
+import ast as _ast
 import os
 import os.path as osp
 import shutil
-from ast import (AST, ClassDef, FunctionDef, Import, ImportFrom,
-                 NodeTransformer, NodeVisitor)
-from collections import OrderedDict, defaultdict
+import sys
+import types
+from ast import (AST, AsyncFunctionDef, ClassDef, FunctionDef, Import,
+                 ImportFrom, NodeTransformer, iter_fields)
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 from typing import Callable, Dict, List, Optional, Union
 
-import astor
-from astpretty import pprint  # for pdb debug
-
-from .parse import DefaultASTParser, Parser, _DefType
+from .parse import DefaultASTParser, Parser, _DefNode, _DefType
 from .utils import cd
 
 __all__ = ["FileLevelCodeGenerator", "SegmentCodeGenerator"]
 
 CODEGEN_PREFIX = "# Generated by CodeSlim\n"
 REMOVE_NODE = None
+# the most frequently visited node classes are tested first by specialized visit.
+_DISPATCH_ORDER = ("ImportFrom", "Name", "Import", "FunctionDef", "ClassDef")
+# ast.unparse is available since python 3.9
+_USE_STDLIB_UNPARSE = sys.version_info >= (3, 9)
+# nodes whose children may hold statements, e.g. the body of except/case clauses
+_STMT_CONTAINERS = tuple(
+    getattr(_ast, i) for i in ("stmt", "excepthandler", "match_case") if hasattr(_ast, i)
+)
 
 
 def _is_file_exist(dir, filename):
@@ -27,6 +36,37 @@ def _get_file_name(file_path):
     return ".".join(file)
 
 
+def _to_source(ast):
+    if _USE_STDLIB_UNPARSE:
+        # the rewritten nodes may miss locations
+        return _ast.unparse(_ast.fix_missing_locations(ast)) + "\n"
+    # only needed before python 3.9
+    import astor
+
+    return astor.to_source(ast)
+
+
+def _rewrite_imports(node: Union[ImportFrom, Import], module_mapper) -> AST:
+    if isinstance(node, ImportFrom) and hasattr(node, "is_target"):
+        module_name = node.module
+        if module_name in module_mapper:
+            module_name = module_mapper[module_name]
+        else:
+            # FIXME(Asthestarsfalll): need automatically get the file where the imported module belongs to
+            module_name = module_name.split(".")[-1]
+            node.level = 0
+        node.module = module_name
+
+    return node
+
+
+def _emit_one(file_name, ast, module_mapper):
+    # run in worker process, so only take picklable arguments.
+    rewrite = partial(_rewrite_imports, module_mapper=module_mapper)
+    Rewriter({"Import": rewrite, "ImportFrom": rewrite}, only_stmts=True).visit(ast)
+    return file_name, _to_source(ast)
+
+
 def _get_local_methods(parser: DefaultASTParser):
     local_methods = {}
     for name, func in parser._local_defs.items():
@@ -51,17 +91,16 @@ class CodeGenerator:
         pass
 
     def _generate_from_str(self, filename, contends: Optional[List[str]] = None):
-        with open(filename, "w", encoding='UTF-8') as f:
-            f.writelines(CODEGEN_PREFIX)
-            if contends:
-                for c in contends:
-                    f.writelines(c)
+        data = "".join([CODEGEN_PREFIX, *contends]) if contends else CODEGEN_PREFIX
+        self._write(filename, data)
 
     def _generate_from_ast(self, filename, ast):
-        source_code = astor.to_source(ast)
-        with open(filename, "w", encoding='UTF-8') as f:
-            f.writelines(CODEGEN_PREFIX)
-            f.write(source_code)
+        self._write(filename, CODEGEN_PREFIX + _to_source(ast))
+
+    def _write(self, filename, data: str):
+        # write once in binary mode to skip the per-chunk work of text io.
+        with open(filename, "wb") as f:
+            f.write(data.encode("UTF-8"))
 
     def generate_init(self, target_path, force=False):
         if not force and _is_file_exist(target_path, "__init__.py"):
@@ -91,35 +130,113 @@ class Rewriter(NodeTransformer):
         targets: Dict[str, Callable],
         pre_hooks: Optional[Dict[str, Callable]] = None,
         post_hooks: Optional[Dict[str, Callable]] = None,
+        only_stmts: bool = False,
     ):
-        for name, func in targets.items():
-            setattr(self, "visit_" + name, func)
-
         self.pre_hooks = pre_hooks or {}
         self.post_hooks = post_hooks or {}
-
-    def visit(self, node):
-        node_name = node.__class__.__name__
-        if node_name in self.pre_hooks:
-            self.pre_hooks[node_name](node)
-        if node is REMOVE_NODE:
-            return node
-        method = "visit_" + node_name
-        visitor = getattr(self, method, self.generic_visit)
-        node = visitor(node)
-        if node_name in self.post_hooks:
-            node = self.post_hooks[node_name](node)
+        # dispatch on the node class itself instead of building
+        # "visit_" + name and calling getattr for every node.
+        # These tables are compiled into the visit function by _build_visit.
+        self._dispatch = self._to_node_classes(targets)
+        self._pre = self._to_node_classes(self.pre_hooks)
+        self._post = self._to_node_classes(self.post_hooks)
+        self._hooked = set(self._dispatch) | set(self._pre) | set(self._post)
+        # only descend into statements, expressions will never be rewritten
+        # when all the targets are statements, e.g. Import/ImportFrom.
+        self._only_stmts = only_stmts
+        # the only dispatcher of Rewriter, it overrides NodeTransformer.visit
+        self.visit = self._build_visit()
+
+    @staticmethod
+    def _to_node_classes(funcs: Dict[str, Callable]):
+        classes = {}
+        for name, func in funcs.items():
+            cls = getattr(_ast, name, None)
+            if not (isinstance(cls, type) and issubclass(cls, AST)):
+                raise ValueError(f"Unknown AST node type: {name}")
+            classes[cls] = func
+        return classes
+
+    def _build_visit(self):
+        """
+        Generate a visit function specialized for the registered node classes:
+            if t is ImportFrom:
+                return _h0(node)
+            ...
+            return _generic(node)
+        so each dispatch is only an identity test of the node class.
+        The handlers and generic_visit are bound as globals of the function
+        to avoid attribute lookups on self.
+        """
+        order = {getattr(_ast, name): i for i, name in enumerate(_DISPATCH_ORDER)}
+        classes = sorted(self._hooked, key=lambda c: order.get(c, len(order)))
+        namespace = {"REMOVE_NODE": REMOVE_NODE, "_generic": self.generic_visit}
+        lines = ["def visit(self, node):", "    t = type(node)"]
+        for i, cls in enumerate(classes):
+            namespace[f"_cls{i}"] = cls
+            lines.append(f"    if t is _cls{i}:")
+            if cls in self._pre:
+                namespace[f"_pre{i}"] = self._pre[cls]
+                lines.append(f"        _pre{i}(node)")
+            visitor = "_generic"
+            if cls in self._dispatch:
+                namespace[f"_h{i}"] = self._dispatch[cls]
+                visitor = f"_h{i}"
+            if cls in self._post:
+                namespace[f"_post{i}"] = self._post[cls]
+                lines.append(f"        return _post{i}({visitor}(node))")
+            else:
+                lines.append(f"        return {visitor}(node)")
+        lines.append("    if node is REMOVE_NODE:")
+        lines.append("        return node")
+        lines.append("    return _generic(node)")
+        exec("\n".join(lines), namespace)
+        return types.MethodType(namespace["visit"], self)
+
+    def generic_visit(self, node):
+        descend = _STMT_CONTAINERS if self._only_stmts else AST
+        # nodes without any handler would only be passed to generic_visit,
+        # so skip the round trip through visit.
+        hooked = self._hooked
+        visit = self.visit
+        generic_visit = self.generic_visit
+        for field, old_value in iter_fields(node):
+            if isinstance(old_value, list):
+                new_values = []
+                append = new_values.append
+                for value in old_value:
+                    if isinstance(value, descend):
+                        if type(value) in hooked:
+                            value = visit(value)
+                        else:
+                            value = generic_visit(value)
+                        if value is None:
+                            continue
+                        elif not isinstance(value, AST):
+                            new_values.extend(value)
+                            continue
+                    append(value)
+                old_value[:] = new_values
+            elif isinstance(old_value, descend):
+                if type(old_value) in hooked:
+                    new_node = visit(old_value)
+                else:
+                    new_node = generic_visit(old_value)
+                if new_node is None:
+                    delattr(node, field)
+                else:
+                    setattr(node, field, new_node)
         return node
 
 
-class _ClassVisitor(NodeVisitor):
-    def __init__(self, cls_node):
-        self.methods = {}
-        self.visit(cls_node)
-
-    def visit_FunctionDef(self, node: FunctionDef):
-        self.methods[node.name] = node
-        return self.generic_visit(node)
+def _get_class_methods(cls_node: ClassDef):
+    # only the methods defined directly in class body are needed,
+    # so do not descend into method bodies.
+    return {
+        node.name: node
+        for node in cls_node.body
+        if isinstance(node, (FunctionDef, AsyncFunctionDef))
+    }
 
 
 # Do we need to support class merging in file-level code slim?
@@ -138,7 +255,10 @@ class ClassMerging:
             {"FunctionDef": self._merge_methods, "Name": self._rewrite_name}
         )
         self.cls_node = parser._local_defs[class_name].node
-        self.methods = _ClassVisitor(self.cls_node).methods
+        self.methods = _get_class_methods(self.cls_node)
+        self._body_append = self.cls_node.body.append
+        # methods merged from the current base class
+        self._merged = []
 
     # TODO
     def _rewrite_super(self):
@@ -147,7 +267,9 @@ class ClassMerging:
     def _merge_methods(self, node):
         if node.name not in self.methods:
             # astor.to_source do not use lineno, so just append it
-            self.cls_node.body.append(node)
+            self._body_append(node)
+            self.methods[node.name] = node
+            self._merged.append(node)
         return node
 
     def _rewrite_name(self, node):
@@ -156,13 +278,24 @@ class ClassMerging:
     def _merge_property(self, node):
         pass
 
+    def _update_dependency(self):
+        # only register the merged methods instead of re-parsing the whole file.
+        local_defs = self.parser._local_defs
+        cls_name = self.cls_node.name
+        for method in self._merged:
+            local_defs[method.name] = _DefNode(self.cls_node, _DefType.Method, cls_name)
+        # FIXME(Asthestarsfalll): the calls inside merged methods belong to the scope
+        #   of base module, need to bring over their dependencies. Do not record them
+        #   into self.parser._calls, they may match different defs with the same name.
+
     def merge(self):
         for base_name, base_parser in self.base_parsers.items():
             self.cur_base = base_name
             base_node = base_parser._local_defs[base_name].node
             self.cls_node.bases = base_node.bases
+            self._merged = []
             self.rewriter.visit(base_node)
-        # FIXME(Asthestarsfalll): need to re-analysis the dependency of each parser.
+            self._update_dependency()
 
 
 # TODO
@@ -176,6 +309,8 @@ class InLine:
 
 
 class FileLevelCodeGenerator(CodeGenerator):
+    _SUPPORT_PARALLEL = True
+
     def __init__(
         self,
         target_dir: str,
@@ -184,6 +319,10 @@ class FileLevelCodeGenerator(CodeGenerator):
         module_mapper: Optional[Dict[str, str]] = None,
         custom_rewriter: Optional[Dict[str, Callable]] = None,
         class_merge_level: Optional[int] = None,
+        # Emit files in a process pool when given. Worker processes may re-import
+        # the main module, so the calling script needs `if __name__ == "__main__"`
+        # guard on spawn-start platforms (Windows, macOS).
+        num_workers: Optional[int] = None,
     ):
         self.target_dir = target_dir
         self.parsers = parser.get_parsers()
@@ -197,6 +336,16 @@ class FileLevelCodeGenerator(CodeGenerator):
             for p in self.parsers.values():
                 p.get_target_merge_class()
         self.merge_level = class_merge_level
+        if num_workers is not None:
+            if not self._SUPPORT_PARALLEL:
+                raise ValueError(
+                    f"{self.__class__.__name__} do not support for parallel generation."
+                )
+            if custom_rewriter is not None:
+                raise ValueError(
+                    "Custom rewriter do not support for parallel generation."
+                )
+        self.num_workers = num_workers
         self.rewriter = self._build_rewriter(custom_rewriter)
         self.imports_info = self._get_imports_info(parser.relations)
         self.relation = parser.relations
@@ -208,17 +357,23 @@ class FileLevelCodeGenerator(CodeGenerator):
         }
         if custom_rewriter is not None:
             rewrite_funcs.update(custom_rewriter)
-        return Rewriter(rewrite_funcs)
+        return Rewriter(rewrite_funcs, only_stmts=custom_rewriter is None)
 
     def _get_imports_info(self, relation):
-        extra_info = defaultdict(list)
+        # the same paths are shared across parsers, intern them to
+        # save memory and make the comparison of them cheaper.
+        extra_info = {}
         for file, target_file in relation.items():
+            file = sys.intern(file)
             for f in target_file:
-                extra_info[f].append(file)
+                extra_info.setdefault(sys.intern(f), []).append(file)
         return extra_info
 
     def generate(self):
         self.makedirs(self.target_dir)
+        if self.num_workers is not None:
+            self._generate_parallel()
+            return
         with cd(self.target_dir):
             for file, parser in self.parsers.items():
                 file_name = osp.basename(parser.file_name)
@@ -230,94 +385,112 @@ class FileLevelCodeGenerator(CodeGenerator):
                 self._postprocess()
                 self._generate_from_ast(file_name, parser.ast)
 
-    def rewrite_imports(self, node: Union[ImportFrom, Import]) -> AST:
-        if isinstance(node, ImportFrom) and hasattr(node, "is_target"):
-            module_name = node.module
-            if module_name in self.module_mapper:
-                module_name = self.module_mapper[module_name]
-            else:
-                # FIXME(Asthestarsfalll): need automatically get the file where the imported module belongs to
-                module_name = module_name.split(".")[-1]
-                node.level = 0
-            node.module = module_name
+    def _generate_parallel(self):
+        # rewriting and unparsing of each file are independent, so run them in
+        # worker processes and only write files in the main process.
+        # NOTE: the rewriting is applied to the copies of ast in worker processes,
+        # parser.ast in main process is left unchanged.
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = []
+            for parser in self.parsers.values():
+                file_name = osp.basename(parser.file_name)
+                # TODO(Asthestarsfalll): need to process __init__ file
+                if file_name == "__init__.py":
+                    continue
+                futures.append(
+                    executor.submit(_emit_one, file_name, parser.ast, self.module_mapper)
+                )
+            with cd(self.target_dir):
+                for future in as_completed(futures):
+                    file_name, source_code = future.result()
+                    self._generate_from_str(file_name, [source_code])
 
-        return node
+    def rewrite_imports(self, node: Union[ImportFrom, Import]) -> AST:
+        return _rewrite_imports(node, self.module_mapper)
 
 
 class SegmentCodeGenerator(FileLevelCodeGenerator):
+    # class merging rewrites the ast of other files, can not run in parallel.
+    _SUPPORT_PARALLEL = False
+
     def _build_rewriter(self, custom_rewriter):
         rewrite_funcs = {
-            "Import": self.rewrite_imports,
-            "ImportFrom": self.rewrite_imports,
+            "Import": self._rewrite_segment_imports,
+            "ImportFrom": self._rewrite_segment_imports,
             "FunctionDef": self.rewrite_defs,
             "ClassDef": self.rewrite_defs,
         }
         if custom_rewriter is not None:
             rewrite_funcs.update(custom_rewriter)
-        pre_hooks = {"ClassDef": self._classdef_hook}
-        return Rewriter(rewrite_funcs, pre_hooks=pre_hooks)
+        # rewrite_defs does not descend into the kept defs, this one is used to
+        # remove the imports of merged base classes inside their bodies.
+        self._class_import_rewriter = Rewriter(
+            {"ImportFrom": self._rewrite_class_imports}, only_stmts=True
+        )
+        return Rewriter(rewrite_funcs, only_stmts=custom_rewriter is None)
 
-    def _classdef_hook(self, node: ClassDef):
-        if node.name not in self.class_merge_info:
-            return node
-        info = self.class_merge_info[node.name]
-        rewrite_parsers = {k: self.parsers[info[k]] for k in info}
-        self.base_parsers = rewrite_parsers
-        ClassMerging(self.cur_parser, rewrite_parsers, node.name).merge()
-        return REMOVE_NODE
+    def _merge_classes(self, parser):
+        for name, info in self.class_merge_info.items():
+            rewrite_parsers = {k: self.parsers[info[k]] for k in info}
+            ClassMerging(parser, rewrite_parsers, name).merge()
 
     def _analyze_local_calls(self, parser):
         calls = parser._calls
         defs = parser._local_defs
-        local_used = []
         # TODO(Asthestarsfalll): reduce the size of calls
-        if calls and defs:
-            # TODO(Asthestarsfalll): need more logic to tackle complex situation.
-            for name, call in calls.items():
-                if name in defs:
-                    local_used.append(name)
-        return local_used
+        if not calls or not defs:
+            return []
+        # TODO(Asthestarsfalll): need more logic to tackle complex situation.
+        # both are dicts, iterate the smaller one and look up in the other.
+        if len(defs) <= len(calls):
+            return [name for name in defs if name in calls]
+        return [name for name in calls if name in defs]
 
     def _rewrite_class_imports(self, node):
         # FIXME
         if isinstance(node, ImportFrom):
             name = node.names[0].asname or node.names[0].name
-            if name in self.base_parsers:
+            if name in self.merged_bases:
                 return REMOVE_NODE
-        else:
-            raise NotImplemented
         return node
 
+    # rewrite imports and remove the imports of merged base classes in one pass,
+    # the imports inside the kept defs are handled by rewrite_defs.
+    def _rewrite_segment_imports(self, node: Union[ImportFrom, Import]):
+        node = self.rewrite_imports(node)
+        if node is REMOVE_NODE:
+            return node
+        return self._rewrite_class_imports(node)
+
     def _preprocess(self, file, parser):
         merge_class = parser._to_merge_classes
-        target_files = defaultdict(OrderedDict)
+        target_files = {}
 
         for path in self.relation[file]:
             p = self.parsers[path]
             for m, bases in merge_class.items():
                 for base in bases:
                     if base in p._local_defs:
-                        target_files[m][base] = path
+                        info = target_files.setdefault(sys.intern(m), {})
+                        info[sys.intern(base)] = sys.intern(path)
+        self.class_merge_info = target_files
+        self.merged_bases = {base for info in target_files.values() for base in info}
+        # merge before collecting the used names, so the merged methods are
+        # registered in parser._local_defs.
+        self._merge_classes(parser)
 
-        extern_uesd = []
-        for i in self.imports_info[file]:
+        extern_used = []
+        for i in self.imports_info.get(file, []):
             p = self.parsers[i]
-            extern_uesd += p.get_target_import_names()
-        self.extern_used = extern_uesd
-        self.local_used = self._analyze_local_calls(parser)
-        self.class_merge_info = target_files
+            extern_used += map(sys.intern, p.get_target_import_names())
+        # only used for membership test in rewrite_defs
+        self.extern_used = frozenset(extern_used)
+        self.local_used = frozenset(map(sys.intern, self._analyze_local_calls(parser)))
         self.cur_parser = parser
 
-    def _postprocess(self):
-        rewriter = Rewriter(
-            {
-                "ImportFrom": self._rewrite_class_imports,
-                "Import": self._rewrite_class_imports,
-            }
-        )
-        rewriter.visit(self.cur_parser.ast)
-
     def rewrite_defs(self, node: Union[FunctionDef, ClassDef]):
         if node.name not in self.extern_used and node.name not in self.local_used:
             return REMOVE_NODE
+        if self.merged_bases:
+            self._class_import_rewriter.generic_visit(node)
         return node
@@ -8,12 +8,13 @@ from typing import Sequence, Union
 
 
 def parse_file(filename: str):
-    ext = os.path.splitext(filename)
-    if ext != ".py":
-        pass
-    with open(filename, "r") as f:
+    # pass bytes to let the tokenizer decode the source by itself,
+    # and keep the filename for error messages.
+    with open(filename, "rb") as f:
         source_code = f.read()
-    return ast.parse(source_code)
+    return compile(
+        source_code, filename, "exec", flags=ast.PyCF_ONLY_AST, dont_inherit=True
+    )
 
 
 class Entry(metaclass=ABCMeta):
@@ -7,8 +7,6 @@ from dataclasses import dataclass
 from enum import Enum
 from typing import Any, Dict, List, Optional, Union
 
-from astpretty import pprint
-
 from .endpoint import EndPointManager, LocalEndPoint
 from .entry import Entry
 from .utils import cd
@@ -262,6 +260,9 @@ class DefaultASTParser(NodeVisitor):
         pass
 
     def print(self):
+        # only for debugging, do not import it at startup
+        from astpretty import pprint
+
         pprint(self.ast)
 
 
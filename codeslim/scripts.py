@@ -34,6 +34,7 @@ class AutoSlim:
         # Maybe we can name this O1 like optimization of gcc hh
         self._merge_class = None
         self._entry_type = FileEntry
+        self._num_workers = None
 
     def mode(self, mode):
         self._mode = mode
@@ -47,11 +48,19 @@ class AutoSlim:
         self._entry_type = type
         return self
 
+    # only for file level, needs `if __name__ == "__main__"` guard on Windows/macOS.
+    def num_workers(self, num_workers):
+        self._num_workers = num_workers
+        return self
+
     def generate(self):
         entry = self._entry_type(self.entries)
         parser = Parser(entry)
         codegen = self._mode(
-            self.target_dir, parser, class_merge_level=self._merge_class
+            self.target_dir,
+            parser,
+            class_merge_level=self._merge_class,
+            num_workers=self._num_workers,
         )
         codegen.generate()
         return self
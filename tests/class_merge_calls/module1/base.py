@@ -0,0 +1,10 @@
+def _fmt(value):
+    return f"<{value}>"
+
+
+class Base(object):
+    def __init__(self, value):
+        self.value = value
+
+    def show(self):
+        return _fmt(self.value)
@@ -0,0 +1,14 @@
+from module1.base import Base
+
+
+def _scale(value):
+    return value * 2
+
+
+def unused(value):
+    return value
+
+
+class Child(Base):
+    def double(self):
+        return Child(_scale(self.value))
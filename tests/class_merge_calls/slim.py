@@ -0,0 +1,8 @@
+from codeslim import AutoSlim
+
+# `Base.show` is merged into `Child`, `_scale` is kept since `Child.double` calls it
+# and `unused` is removed.
+# NOTE: `_fmt` which the merged `Base.show` depends on is not brought over yet.
+AutoSlim("./module2/child.py", "./target/").mode(AutoSlim.SegmentLevel).merge_class(
+    AutoSlim.Eliminate
+).generate()
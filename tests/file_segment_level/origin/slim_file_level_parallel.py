@@ -0,0 +1,4 @@
+from codeslim import AutoSlim
+
+if __name__ == "__main__":
+    AutoSlim("./train.py", "../file_level_parallel/").num_workers(2).generate()